@@ -1,59 +1,88 @@
 #!/usr/bin/env python3
 
-from __future__ import division, print_function
-
+import atexit
+import logging
+import math
 import os
+import queue
 import re
 import sqlite3
+import threading
 import time
-from collections import Counter, namedtuple
+from argparse import ArgumentParser
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from optparse import OptionParser
+from itertools import chain, islice
 
 import keyboardlayout as kl
 import keyboardlayout.pygame as klp
-import matplotlib.pyplot as plt
-import pandas as pd
 import pygame
-import seaborn as sns
 
 import xlib
 from xlib import XEvents
 
+log = logging.getLogger('kbdcounter')
+
 KEY_SIZE = 60
 PADDING = 10
 
 
-def draw_heatmap_on_keys(screen, data, key_positions, background_color):
-    # Draw the heatmap on the keyboard layout
+def build_heatmap_overlays(data, key_positions):
+    """Render the translucent rectangle and count text for every key once,
+    as (surface, position, text surface, text rect) for draw_heatmap_on_keys
+    """
+    overlays = []
+    max_count = max(data.values(), default=0)
+    font = pygame.font.SysFont('monospace', KEY_SIZE // 5)
+    text_color = pygame.Color('white')
     for key_id, count in data.items():
-        # Get the key rect from the layout
-        key_rect = key_positions[key_id]
+        # Get the key rect from the layout; keys it doesn't have aren't drawn
+        key_rect = key_positions.get(key_id)
+        if key_rect is None:
+            continue
 
         # Customize the heatmap's color and transparency (alpha) based on the count
-        color = pygame.Color(240, 20, 30, int(200 * count / max(data.values())))
+        color = pygame.Color(240, 20, 30, int(200 * count / max_count))
 
-        # Draw a translucent rectangle for each key with the appropriate color
+        # A translucent rectangle for each key with the appropriate color
         surf = pygame.Surface((key_rect.width - PADDING, key_rect.height - PADDING), pygame.SRCALPHA)
         surf.fill(color)
-        screen.blit(surf, (key_rect.x + PADDING/2, key_rect.y + PADDING/2)) # Modified this line to use x and y attributes
+        position = (key_rect.x + PADDING/2, key_rect.y + PADDING/2)
 
-        # Add key count text
-        font = pygame.font.SysFont('monospace', KEY_SIZE // 5)
-        text_surface = font.render(str(int(count)), True, pygame.Color('white'))
+        # Key count text
+        text_surface = font.render(str(int(count)), True, text_color)
         text_rect = text_surface.get_rect()
         text_rect.topright = (key_rect.x + key_rect.width - PADDING, key_rect.y + key_rect.height - PADDING - KEY_SIZE//5) # Right
+
+        overlays.append((surf, position, text_surface, text_rect))
+    return overlays
+
+
+def draw_heatmap_on_keys(screen, overlays):
+    # Draw the heatmap on the keyboard layout
+    for surf, position, text_surface, text_rect in overlays:
+        screen.blit(surf, position)
         screen.blit(text_surface, text_rect)
 
 
+_DIGIT_KEY = re.compile(r'KEY_DIGIT_(\d)')
+_SIDED_KEY = re.compile(r'KEY_([RL])_(.+)')
+
+
 def format_key_name(key):
     key = str(key).replace("Key.", "KEY_").replace("LEFT_", "L_").replace("RIGHT_", "R_")
-    key = re.sub(r'KEY_DIGIT_(\d)', r'KEY_\1', key)
-    key = re.sub(r'KEY_([RL])_(.+)', r'KEY_\2_\1', key)
+    key = _DIGIT_KEY.sub(r'KEY_\1', key)
+    key = _SIDED_KEY.sub(r'KEY_\2_\1', key)
     key = key.replace("KEY_SHIFT_R", 'KEY_ISO_LEVEL3_SHIFT').replace("META", "SUPER")
     return key
 
 
+def get_key_positions(keyboard_layout):
+    # Map our key names to the rect of the first location of each layout key
+    return {format_key_name(key): next(iter(rects.values())) for key, rects in keyboard_layout._rect_by_key_and_loc.items()}
+
+
 def get_screen():
     XY = namedtuple('XY', ['x', 'y'])
     try:
@@ -81,6 +110,82 @@ MODIFIERS = {
     'KEY_META_R': 0x8,
     'KEY_SUPER_R': 0x10,}
 
+# Modifier state bits as plain names, so per-row code skips the dict lookups
+_M_SHIFT = MODIFIERS['KEY_SHIFT_L']
+_M_CTRL = MODIFIERS['KEY_CONTROL_L']
+_M_ALT = MODIFIERS['KEY_ALT_L']
+_M_META = MODIFIERS['KEY_META_L']
+_M_SUPER = MODIFIERS['KEY_SUPER_L']
+
+# modifier state: (shift, ctrl, alt, meta, super) flags, for all 32 states
+_MOD_BITS = {
+    m: ((m & _M_SHIFT) > 0, (m & _M_CTRL) > 0, (m & _M_ALT) > 0, (m & _M_META) > 0, (m & _M_SUPER) > 0)
+    for m in range(32)}
+
+# Event types as produced by xlib.XEvents
+_EV_KEY = 'EV_KEY'
+_EV_MOV = 'EV_MOV'
+_EV_REL = 'EV_REL'
+
+# Snapshots the writer thread keeps for retrying while the database is
+# unwritable; a day's worth at one save per 5 minutes
+MAX_PENDING_SAVES = 288
+
+# "insert ... on conflict do update" needs SQLite 3.24+
+HAS_UPSERT = sqlite3.sqlite_version_info >= (3, 24, 0)
+
+# Statements for the save path, built once so each save hands sqlite3 the
+# same strings. keyboard and mouse share one shape, so they share templates.
+_COUNT_UPSERT = '''
+    insert into {table} (
+        id,
+        shift, ctrl, alt, meta, super,
+        count, day, hour)
+    values (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    on conflict (id, day, hour, shift, ctrl, alt, meta, super)
+        do update set count = count + excluded.count'''
+
+# For SQLite without upsert; ?N lets it bind the same row tuple as the insert
+_COUNT_UPDATE = '''
+    update or ignore {table}
+        set count = count + ?7
+    where
+        id = ?1
+    and shift = ?2
+    and ctrl = ?3
+    and alt = ?4
+    and meta = ?5
+    and super = ?6
+    and day = ?8
+    and hour = ?9'''
+
+_COUNT_INSERT = '''
+    insert or ignore into {table} (
+        id,
+        shift, ctrl, alt, meta, super,
+        count, day, hour)
+    values (?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+
+# table: (upsert, update, insert)
+_COUNT_SQL = {
+    table: (_COUNT_UPSERT.format(table=table), _COUNT_UPDATE.format(table=table), _COUNT_INSERT.format(table=table))
+    for table in ('keyboard', 'mouse')}
+
+_DISTANCE_UPSERT = '''
+    insert into mouse_distance(x, y, dist, day, hour)
+        values (:x, :y, :dist, :day, :hour)
+    on conflict (day, hour) do update set
+        x = x + excluded.x,
+        y = y + excluded.y,
+        dist = sqrt((x + excluded.x) * (x + excluded.x) + (y + excluded.y) * (y + excluded.y))'''
+
+_DISTANCE_SELECT = '''select x, y from mouse_distance
+                        where day = :day and hour = :hour'''
+_DISTANCE_DELETE = '''delete from mouse_distance
+                        where day = :day and hour = :hour'''
+_DISTANCE_INSERT = '''insert into mouse_distance(x, y, dist, day, hour)
+                        values (:x, :y, :dist, :day, :hour)'''
+
 
 class Storage:
     # Simple record storage.
@@ -121,129 +226,147 @@ create table keyboard(
     primary key (day, hour)
 );''', '''create table schema_version(version int);''', '''insert into schema_version(version) values (1);''']
 
+    # Created on every start, so databases from older versions get them too
+    INDEXES = [
+        'create index if not exists idx_keyboard_day_hour on keyboard(day, hour);',
+        'create index if not exists idx_mouse_day_hour on mouse(day, hour);',
+        # covering indexes for the per-id totals in --report and --heatmap
+        'create index if not exists idx_keyboard_id_count on keyboard(id, count);',
+        'create index if not exists idx_mouse_id_count on mouse(id, count);',]
+
+    # Applied to every connection. WAL lets --report read while the counter
+    # writes, and with synchronous=NORMAL a commit costs a single sync.
+    PRAGMAS = [
+        'pragma journal_mode = wal',
+        'pragma synchronous = normal',
+        'pragma temp_store = memory',
+        'pragma mmap_size = 268435456',
+        'pragma cache_size = -20000',]
+
+    # Rows bound per executemany() call when flushing counters
+    BATCH_SIZE = 100
+
     def __init__(self, path):
         self.db = path
-        with sqlite3.connect(self.db) as conn:
-            create = False
-            try:
-                conn.execute('select version from schema_version')
-            except sqlite3.OperationalError:
-                create = True
-
-            if create:
-                print("Initialize database...")
+        # One connection for the lifetime of the Storage, in autocommit mode;
+        # writes are grouped with _transaction()
+        self.conn = self._connect()
+        atexit.register(self.close)
+
+        create = False
+        try:
+            self.conn.execute('select version from schema_version')
+        except sqlite3.OperationalError:
+            create = True
+
+        if create:
+            print("Initialize database...")
+            with self._transaction(self.conn):
                 for statement in self.SCHEMA:
                     print(statement)
-                    conn.execute(statement)
+                    self.conn.execute(statement)
+
+        with self._transaction(self.conn):
+            for statement in self.INDEXES:
+                self.conn.execute(statement)
+
+    def _connect(self):
+        # KbdCounter writes through this connection from its writer thread
+        conn = sqlite3.connect(self.db, isolation_level=None, check_same_thread=False)
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
+        # SQLite only has sqrt() when built with its math functions
+        conn.create_function('sqrt', 1, math.sqrt, deterministic=True)
+        return conn
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    @contextmanager
+    def _transaction(self, conn):
+        """Run the enclosed statements as one transaction (one commit)
+        """
+        conn.execute('begin immediate')
+        try:
+            yield conn
+            conn.execute('commit')
+        except BaseException:
+            # SQLite rolls back by itself on some errors (e.g. disk full);
+            # otherwise the failed transaction would wedge the connection
+            if conn.in_transaction:
+                conn.execute('rollback')
+            raise
+
+    def reset(self):
+        """Roll back anything left open on the connection after an error
+        """
+        if self.conn is not None and self.conn.in_transaction:
+            self.conn.execute('rollback')
 
-    def _write_keyboard(self, conn, keyboard, when, hour):
-        keyboard_update = '''
-            update or ignore keyboard
-                set count = count + :count
-            where
-                id = :key
-            and shift = :shift
-            and ctrl = :ctrl
-            and alt = :alt
-            and meta = :meta
-            and super = :super
-            and day = :day
-            and hour = :hour'''
-
-        keyboard_insert = '''insert or ignore into keyboard (
-                id,
-                shift, ctrl, alt, meta, super,
-                count, day, hour)
-            values (
-                :key,
-                :shift, :ctrl, :alt, :meta, :super,
-                :count, :day, :hour)'''
-
-        params = [{
-            'key': key[0],
-            'count': value,
-            'day': when,
-            'hour': hour,
-            'shift': (key[1] & MODIFIERS['KEY_SHIFT_L']) > 0,
-            'ctrl': (key[1] & MODIFIERS['KEY_CONTROL_L']) > 0,
-            'alt': (key[1] & MODIFIERS['KEY_ALT_L']) > 0,
-            'meta': (key[1] & MODIFIERS['KEY_META_L']) > 0,
-            'super': (key[1] & MODIFIERS['KEY_SUPER_L']) > 0,} for key, value in keyboard.items()]
+    def _executemany(self, conn, sql, params):
+        """executemany() in batches of BATCH_SIZE rows
+        """
+        # Feed each batch straight from the iterator, without building lists
+        params = iter(params)
+        for first in params:
+            conn.executemany(sql, chain((first,), islice(params, self.BATCH_SIZE - 1)))
+
+    def _rows(self, counts, when, hour):
+        """Yield (id, shift, ctrl, alt, meta, super, count, day, hour) tuples
+        for a map of (id, modifier state): count
+        """
+        return ((key, *_MOD_BITS[mods & 0x1F], value, when, hour) for (key, mods), value in counts.items())
 
-        # First, update any values that exist
-        conn.executemany(keyboard_update, params)
+    def _write_counts(self, conn, table, counts, when, hour):
+        upsert, update, insert = _COUNT_SQL[table]
+        params = self._rows(counts, when, hour)
 
-        # Then, insert any new values
-        conn.executemany(keyboard_insert, params)
+        if HAS_UPSERT:
+            self._executemany(conn, upsert, params)
+            return
 
-    def _write_mouse(self, conn, mouse, when, hour):
-        mouse_update = '''
-            update or ignore mouse
-                set count = count + :count
-            where
-                id = :key
-            and shift = :shift
-            and ctrl = :ctrl
-            and alt = :alt
-            and meta = :meta
-            and super = :super
-            and day = :day
-            and hour = :hour'''
-
-        mouse_insert = '''
-            insert or ignore into mouse(id,
-                shift, ctrl, alt, meta, super,
-                count, day, hour)
-            values (
-                :key,
-                :shift, :ctrl, :alt, :meta, :super,
-                :count, :day, :hour)'''
-
-        params = [{
-            'key': key[0],
-            'count': value,
-            'day': when,
-            'hour': hour,
-            'shift': (key[1] & MODIFIERS['KEY_SHIFT_L']) > 0,
-            'ctrl': (key[1] & MODIFIERS['KEY_CONTROL_L']) > 0,
-            'alt': (key[1] & MODIFIERS['KEY_ALT_L']) > 0,
-            'meta': (key[1] & MODIFIERS['KEY_META_L']) > 0,
-            'super': (key[1] & MODIFIERS['KEY_SUPEsR_L']) > 0,} for key, value in mouse.items()]
+        params = list(params)
 
         # First, update any values that exist
-        conn.executemany(mouse_update, params)
+        self._executemany(conn, update, params)
 
         # Then, insert any new values
-        conn.executemany(mouse_insert, params)
+        self._executemany(conn, insert, params)
+
+    def _write_keyboard(self, conn, keyboard, when, hour):
+        self._write_counts(conn, 'keyboard', keyboard, when, hour)
+
+    def _write_mouse(self, conn, mouse, when, hour):
+        self._write_counts(conn, 'mouse', mouse, when, hour)
 
     def _write_mouse_distance(self, conn, distance, when, hour):
         x, y = distance
 
-        select = '''select x, y from mouse_distance
-                        where day = :day and hour = :hour'''
-        delete = '''delete from mouse_distance
-                        where day = :day and hour = :hour'''
-        insert = '''insert into mouse_distance(x, y, dist, day, hour)
-                        values (:x, :y, :dist, :day, :hour)'''
+        if HAS_UPSERT:
+            dist = (x**2 + y**2)**0.5
+            conn.execute(_DISTANCE_UPSERT, {'x': x, 'y': y, 'dist': dist, 'day': when, 'hour': hour})
+            return
 
-        row = conn.execute(select, {'day': when, 'hour': hour})
+        row = conn.execute(_DISTANCE_SELECT, {'day': when, 'hour': hour})
         row = row.fetchone()
         if row:
             oldx = row[0]
             oldy = row[1]
             x += oldx
             y += oldy
-            conn.execute(delete, {'day': when, 'hour': hour})
+            conn.execute(_DISTANCE_DELETE, {'day': when, 'hour': hour})
 
         dist = (x**2 + y**2)**0.5
-        conn.execute(insert, {'x': x, 'y': y, 'dist': dist, 'day': when, 'hour': hour})
+        conn.execute(_DISTANCE_INSERT, {'x': x, 'y': y, 'dist': dist, 'day': when, 'hour': hour})
 
     def write_data(self, keyboard, mouse, when, distance):
-        hour = when.strftime('%H')
+        hour = when.hour
         when = when.date()
-        print("Hour =", hour, "when =", when)
+        print(f"Hour = {hour} when = {when}")
 
-        with sqlite3.connect(self.db) as conn:
+        with self._transaction(self.conn) as conn:
             self._write_keyboard(conn, keyboard, when, hour)
             self._write_mouse(conn, mouse, when, hour)
             self._write_mouse_distance(conn, distance, when, hour)
@@ -251,9 +374,9 @@ create table keyboard(
     def clear_current_hour(self):
         """Zero the last hour
         """
-        with sqlite3.connect(self.db) as conn:
+        with self._transaction(self.conn) as conn:
             when = datetime.now()
-            hour = when.strftime('%H')
+            hour = when.hour
             when = when.date()
             params = {'when': when, 'hour': hour}
             conn.execute('delete from keyboard where day = :when and hour = :hour', params)
@@ -263,7 +386,7 @@ create table keyboard(
     def clear_current_day(self):
         """Zero the current day
         """
-        with sqlite3.connect(self.db) as conn:
+        with self._transaction(self.conn) as conn:
             when = datetime.now().date()
             params = {'when': when}
             conn.execute('delete from keyboard where day = :when', params)
@@ -273,54 +396,49 @@ create table keyboard(
     def clear_all(self):
         """Zero everything (removes database)
         """
+        self.close()
         os.remove(self.db)
+        # WAL mode leaves these beside the database
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(self.db + suffix):
+                os.remove(self.db + suffix)
 
     def print_stats(self):
-        with sqlite3.connect(self.db) as conn:
-            top5_keys = 'select id, sum(count) from keyboard group by id order by 2 desc limit 5'
-            cursor = conn.execute(top5_keys)
-            row = cursor.fetchall()
-            print("Top 5 Keys:", row)
-
-            when = datetime.now()
-            hour = when.strftime('%H')
-            when = when.date()
-            total_mouse_this_hour = '''
-            select x, y from mouse_distance
-            where day = :when and hour = :hour'''
-            cursor = conn.execute(total_mouse_this_hour, {'when': when, 'hour': hour})
-            row = cursor.fetchone()
-
-            screen_px, screen_mm = get_screen()
-            mm_px_x = screen_mm.x / screen_px.x
-            mm_px_y = screen_mm.y / screen_px.y
-
-            inch_per_foot = 12
-            foot_per_meter = 1 / 0.3048
-            meter_per_mm = 0.001
-            inch_per_mm = inch_per_foot * foot_per_meter * meter_per_mm
-            # IN FT M_ MM
-            # FT M_ MM PX
-
-            in_px_x = mm_px_x * inch_per_mm
-            in_px_y = mm_px_y * inch_per_mm
-
-            x_px, y_px = row
-            mouse_distance_m = ((x_px * mm_px_x * meter_per_mm)**2 + (y_px * mm_px_y * meter_per_mm)**2)**0.5
-            print("Mouse distance during current hour: %.1f meters" % (mouse_distance_m))
-
-            mouse_buttons = 'select id, sum(count) from mouse group by id order by count desc limit 5'
-            cursor = conn.execute(mouse_buttons)
-            row = cursor.fetchall()
-            print("Mouse buttons:", row)
+        conn = self.conn
+        top5_keys = 'select id, sum(count) as c from keyboard group by id order by c desc limit 5'
+        cursor = conn.execute(top5_keys)
+        row = cursor.fetchall()
+        print(f"Top 5 Keys: {row}")
+
+        when = datetime.now()
+        hour = when.hour
+        when = when.date()
+        total_mouse_this_hour = '''
+        select x, y from mouse_distance
+        where day = :when and hour = :hour'''
+        cursor = conn.execute(total_mouse_this_hour, {'when': when, 'hour': hour})
+        row = cursor.fetchone()
+
+        screen_px, screen_mm = get_screen()
+        m_per_px_x = screen_mm.x / screen_px.x * 1e-3
+        m_per_px_y = screen_mm.y / screen_px.y * 1e-3
+
+        # no row yet if the mouse hasn't moved this hour
+        x_px, y_px = row or (0, 0)
+        mouse_distance_m = math.hypot(x_px * m_per_px_x, y_px * m_per_px_y)
+        print(f"Mouse distance during current hour: {mouse_distance_m:.1f} meters")
+
+        mouse_buttons = 'select id, sum(count) as c from mouse group by id order by c desc limit 5'
+        cursor = conn.execute(mouse_buttons)
+        row = cursor.fetchall()
+        print(f"Mouse buttons: {row}")
 
     def generate_heatmap(self):
         # Get data from database
-        with sqlite3.connect(self.db) as conn:
-            query = 'SELECt id, SUM(count) FROM keyboard GROUP BY id'
-            cursor = conn.execute(query)
-            data = cursor.fetchall()
-        data = {d[0]: d[1] for d in data if d[0].startswith('KEY_')}
+        # glob is case-sensitive like str.startswith, and unlike like() it
+        # lets SQLite range-search the primary key index on id
+        query = "SELECT id, SUM(count) FROM keyboard WHERE id GLOB 'KEY_*' GROUP BY id"
+        data = dict(self.conn.execute(query))
 
         # initialize pygame
         pygame.init()
@@ -339,74 +457,178 @@ create table keyboard(
         letter_key_size = (KEY_SIZE, KEY_SIZE)
         keyboard_layout = klp.KeyboardLayout(layout_name, keyboard_info, letter_key_size, key_info)
 
-        # draw the keyboard on the pygame screen
         screen = pygame.display.set_mode((keyboard_layout.rect.width, keyboard_layout.rect.height))
-        screen.fill(white)
-        keyboard_layout.draw(screen)
-        pygame.display.update()
-
-        key_positions = {format_key_name(key): list(rect.values())[0] for (key, rect) in keyboard_layout._rect_by_key_and_loc.items()} # yapf: disable
-
-        running = True
-        while running:
-            # loop until the user closes the pygame window
-            for event in pygame.event.get():
-                if event.type == pygame.QUIT:
-                    pygame.display.quit()
-                    running = False
-            if not running:
+        key_positions = get_key_positions(keyboard_layout)
+        overlays = build_heatmap_overlays(data, key_positions)
+
+        # The picture never changes, so draw it once and then only again
+        # when the window needs repainting
+        redraw_events = {pygame.VIDEOEXPOSE, pygame.VIDEORESIZE, pygame.WINDOWEXPOSED}
+        redraw = True
+        while True:
+            if redraw:
+                # draw the keyboard on the pygame screen, then the heatmap on the keys
+                screen.fill(white)
+                keyboard_layout.draw(screen)
+                draw_heatmap_on_keys(screen, overlays)
+                pygame.display.update()
+
+            # sleep until the next event; loop until the user closes the window
+            event = pygame.event.wait()
+            if event.type == pygame.QUIT:
                 break
-            # Redraw the keyboard
-            keyboard_layout.draw(screen)
-            # Draw the heatmap on the keys
-            draw_heatmap_on_keys(screen, data=data, key_positions=key_positions, background_color=white_darker)
-            pygame.display.update()
+            redraw = event.type in redraw_events
 
         pygame.quit()
 
 
 def is_mouse(event):
-    return event.type.startswith('EV_MOV', 'EV_REL')
+    return event.type in (_EV_MOV, _EV_REL)
 
 
 class KbdCounter(object):
     def __init__(self, options):
         self.storepath = os.path.expanduser(options.storepath)
+        self.storage = Storage(self.storepath)
+        self.verbose = options.verbose
 
         self.set_thishour()
         self.set_nextsave()
 
         # map of (KEY_I, M): K, where M = modifier state, K = count
-        self.keyboard_events = Counter()
+        self.keyboard_events = defaultdict(int)
         # map of (BTN_LEFT, M): count
-        self.mouse_events = Counter()
+        self.mouse_events = defaultdict(int)
 
         self.mouse_distance_x = 0
         self.mouse_distance_y = 0
         self.wheel_up = 0
         self.wheel_down = 0
 
+        self.modifier_state = 0
+        self.last_mov = None
+
+        # event type: handler, so run() does one lookup per event
+        self.handlers = {
+            _EV_KEY: self._on_key,
+            _EV_MOV: self._on_mov,
+            _EV_REL: self._on_rel,}
+
+        # Saves are (keyboard, mouse, hour, distance) snapshots, written to
+        # the database by a separate thread so disk I/O never stalls the loop
+        self.write_queue = queue.Queue()
+        self.writer = threading.Thread(target=self._writer_loop, name='kbdcounter-writer', daemon=True)
+        self.writer.start()
+
     def set_thishour(self):
         self.thishour = datetime.now().replace(minute=0, second=0, microsecond=0)
         self.nexthour = self.thishour + timedelta(hours=1)
         self.thishour_count = 0
 
-    def set_nextsave(self):
+    def set_nextsave(self, now=None):
         save_every = 300 # 5 minutes
-        now = time.time()
-        self.nextsave = now + min((self.nexthour - datetime.now()).seconds + 1, save_every)
+        if now is None:
+            now = time.time()
+        self.nextsave = now + min((self.nexthour - datetime.fromtimestamp(now)).seconds + 1, save_every)
 
-    def save(self):
-        self.set_nextsave()
-        storage = Storage(self.storepath)
-        try:
-            storage.write_data(self.keyboard_events, self.mouse_events, self.thishour, (self.mouse_distance_x, self.mouse_distance_y))
-            self.keyboard_events.clear()
-            self.mouse_events.clear()
-            self.mouse_distance_x = 0
-            self.mouse_distance_y = 0
-        except sqlite3.OperationalError as e:
-            print("Error saving data", e)
+    def save(self, now=None):
+        """Hand the counts so far to the writer thread and start afresh
+        """
+        self.set_nextsave(now)
+        self.write_queue.put((self.keyboard_events, self.mouse_events, self.thishour,
+                              (self.mouse_distance_x, self.mouse_distance_y)))
+        # The writer owns the queued counters now; swap in new ones
+        self.keyboard_events = defaultdict(int)
+        self.mouse_events = defaultdict(int)
+        self.mouse_distance_x = 0
+        self.mouse_distance_y = 0
+
+    def _writer_loop(self):
+        """Write queued saves to storage, off the event loop thread.
+        A None entry stops the loop.
+        """
+        failed = []
+        while True:
+            snapshot = self.write_queue.get()
+            if snapshot is not None:
+                failed.append(snapshot)
+
+            # Retry anything that failed before, oldest first
+            while failed:
+                try:
+                    self.storage.write_data(*failed[0])
+                    failed.pop(0)
+                except sqlite3.OperationalError as e:
+                    # e.g. database locked or disk full; worth another try
+                    print(f"Error saving data {e}")
+                    self.storage.reset()
+                    if len(failed) > MAX_PENDING_SAVES:
+                        log.warning("Dropping %d unsaved snapshots", len(failed) - MAX_PENDING_SAVES)
+                        del failed[:-MAX_PENDING_SAVES]
+                    break
+                except Exception:
+                    # Anything else would fail the same way again, so report it
+                    # rather than let it kill the writer thread
+                    log.exception("Dropping unsaveable data")
+                    failed.pop(0)
+
+            if snapshot is None:
+                return
+
+    def _on_key(self, evt):
+        code = evt.code
+
+        # read modifier state
+        mask = MODIFIERS.get(code)
+        if mask is not None:
+            if evt.value:
+                self.modifier_state |= mask
+            else:
+                self.modifier_state &= ~mask
+
+        # Key press (evt.value == 1) or release (evt.value == 0)
+        if evt.value != 1:
+            return
+
+        prefix = code[:3]
+        if prefix == 'KEY':
+            if code == 'KEY_DUNNO':
+                idx = (evt.scancode, self.modifier_state)
+            else:
+                idx = (code, self.modifier_state)
+            self.keyboard_events[idx] += 1
+        elif prefix == 'BTN':
+            self.mouse_events[(code, self.modifier_state)] += 1
+
+        if self.verbose and mask is None:
+            self._log_event(evt)
+
+    def _on_mov(self, evt):
+        # EV_MOV's value is a tuple with the current mouse coordinates.
+        # To track movement, we need to compare with the last position
+        pos = evt.value
+        last = self.last_mov
+        if last:
+            self.mouse_distance_x += abs(pos[0] - last[0])
+            self.mouse_distance_y += abs(pos[1] - last[1])
+
+        self.last_mov = pos
+
+    def _on_rel(self, evt):
+        # Scrolling
+        if evt.code == 'REL_WHEEL':
+            if evt.value > 0:
+                self.mouse_events[('WHEEL_UP', self.modifier_state)] += evt.value
+            if evt.value < 0:
+                self.mouse_events[('WHEEL_DOWN', self.modifier_state)] += -evt.value
+            if self.verbose:
+                self._log_event(evt)
+
+    def _log_event(self, evt):
+        # Only called with --verbose, so the default path skips it per keystroke
+        # S(hift) C(trl) A(lt) M(eta) (s)U(per) as 0/1 flags
+        log.debug("type %s value %s code %s scancode %s S:%d C:%d A:%d M:%d U:%d", evt.type, evt.value, evt.code,
+                  evt.scancode, *_MOD_BITS[self.modifier_state & 0x1F])
 
     def run(self):
         events = XEvents()
@@ -415,98 +637,70 @@ class KbdCounter(object):
             # Wait for init
             time.sleep(1)
 
-        last_mov = None
+        handlers = self.handlers
 
         try:
-            modifier_state = 0
-
+            now = time.time()
             while events.listening():
-                evt = events.next_event()
-                if not evt:
-                    time.sleep(0.5)
-                    continue
-
-                # read modifier state
-                if evt.type == 'EV_KEY' and evt.code in MODIFIERS.keys():
-                    if evt.value:
-                        modifier_state |= MODIFIERS[evt.code]
-                    else:
-                        modifier_state &= ~MODIFIERS[evt.code]
-
-                # Key press (evt.value == 1) or release (evt.value == 0)
-                if evt.type == 'EV_KEY' and evt.value == 1:
-                    if evt.code.startswith('KEY'):
-                        if evt.code == 'KEY_DUNNO':
-                            idx = (evt.scancode, modifier_state)
-                        else:
-                            idx = (evt.code, modifier_state)
-                        self.keyboard_events[idx] += 1
-
-                    if evt.code.startswith('BTN'):
-                        self.mouse_events[(evt.code, modifier_state)] += 1
-
-                if evt.type == 'EV_MOV':
-                    # EV_MOV's value is a tuple with the current mouse coordinates.
-                    # To track movement, we need to compare with the last position
-                    x, y = evt.value
-                    if last_mov:
-                        self.mouse_distance_x += abs(x - last_mov[0])
-                        self.mouse_distance_y += abs(y - last_mov[1])
-
-                    last_mov = x, y
-
-                # Scrolling
-                if evt.type == 'EV_REL':
-                    if evt.code == 'REL_WHEEL':
-                        if evt.value > 0:
-                            self.mouse_events[('WHEEL_UP', modifier_state)] += evt.value
-                        if evt.value < 0:
-                            self.mouse_events[('WHEEL_DOWN', modifier_state)] += -evt.value
-
-                if evt.code == 'REL_WHEEL' or (evt.type == 'EV_KEY' and evt.value == 1 and evt.code not in MODIFIERS.keys(
-                )):
-                    print("type %s value %s code %s scancode %s" % (evt.type, evt.value, evt.code, evt.scancode),
-                          end=' ')
-                    print("S:%d C:%d A:%d M:%d S:%d" % (modifier_state & MODIFIERS['KEY_SHIFT_L'], modifier_state & MODIFIERS['KEY_CONTROL_L'], modifier_state
-                                                        & MODIFIERS['KEY_ALT_L'], modifier_state & MODIFIERS['KEY_META_L'], modifier_state & MODIFIERS['KEY_SUPER_L']))
-
-                if time.time() > self.nextsave:
-                    print("Mouse:", self.mouse_distance_x, self.mouse_distance_y)
-                    self.save()
-
-                    if datetime.now().hour != self.thishour.hour:
+                # Sleep until the next event or the next save, whichever is first
+                evt = events.next_event(self.nextsave - now)
+                if evt:
+                    handler = handlers.get(evt.type)
+                    if handler:
+                        handler(evt)
+
+                now = time.time()
+                if now > self.nextsave:
+                    print(f"Mouse: {self.mouse_distance_x} {self.mouse_distance_y}")
+                    self.save(now)
+
+                    if datetime.fromtimestamp(now).hour != self.thishour.hour:
                         self.set_thishour()
 
         except KeyboardInterrupt:
+            pass
+        finally:
+            # However the loop ended, flush the last counts and let the writer
+            # drain before exit (and atexit) can close the database under it
             events.stop_listening()
             self.save()
+            self.write_queue.put(None)
+            self.writer.join()
 
 
 def run():
-    oparser = OptionParser()
-    oparser.add_option("--storepath",
-                       dest="storepath",
-                       help="Filename into which number of keypresses per hour is written",
-                       default="kbdcounter.db")
-    oparser.add_option("--report", dest='report', action="store_true", help="Print some statistics", default=False)
-    oparser.add_option("--heatmap", dest='heatmap', action="store_true", help="Show a graphical heatmap", default=False)
-    oparser.add_option("--zero-hour",
-                       dest='zero_hour',
-                       action="store_true",
-                       help="Zero data for the current hour",
-                       default=False)
-    oparser.add_option("--zero-day",
-                       dest='zero_day',
-                       action="store_true",
-                       help="Zero data for the current day",
-                       default=False)
-    oparser.add_option("--zero-all",
-                       dest='zero_all',
-                       action="store_true",
-                       help="Zero all data (erases database file)",
-                       default=False)
-
-    (options, args) = oparser.parse_args()
+    parser = ArgumentParser()
+    parser.add_argument("--storepath",
+                        dest="storepath",
+                        help="Filename into which number of keypresses per hour is written",
+                        default="kbdcounter.db")
+    parser.add_argument("--verbose",
+                        "--debug",
+                        dest='verbose',
+                        action="store_true",
+                        help="Print every counted key press and scroll",
+                        default=False)
+    parser.add_argument("--report", dest='report', action="store_true", help="Print some statistics", default=False)
+    parser.add_argument("--heatmap", dest='heatmap', action="store_true", help="Show a graphical heatmap", default=False)
+    parser.add_argument("--zero-hour",
+                        dest='zero_hour',
+                        action="store_true",
+                        help="Zero data for the current hour",
+                        default=False)
+    parser.add_argument("--zero-day",
+                        dest='zero_day',
+                        action="store_true",
+                        help="Zero data for the current day",
+                        default=False)
+    parser.add_argument("--zero-all",
+                        dest='zero_all',
+                        action="store_true",
+                        help="Zero all data (erases database file)",
+                        default=False)
+
+    options = parser.parse_args()
+
+    logging.basicConfig(format='%(message)s', level=logging.DEBUG if options.verbose else logging.INFO)
 
     options.storepath = os.path.expanduser(options.storepath)
     options.storepath = os.path.expandvars(options.storepath)
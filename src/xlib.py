@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/env python3
 #
 # Copyright 2010 Google Inc.
 #
@@ -31,6 +31,7 @@ import sys
 import time
 import threading
 import collections
+import queue
 
 
 class XEvent(object):
@@ -80,19 +81,23 @@ class XEvents(threading.Thread):
 
     def __init__(self):
         threading.Thread.__init__(self)
-        self.setDaemon(True)
-        self.setName('Xlib-thread')
+        self.daemon = True
+        self.name = 'Xlib-thread'
         self._listening = False
         self.record_display = display.Display()
         self.local_display = display.Display()
         self.ctx = None
         self.keycode_to_symbol = collections.defaultdict(lambda: 'KEY_DUNNO')
         self._setup_lookup()
-        self.events = []  # each of type XEvent
+        self.events = queue.Queue()  # each of type XEvent
 
     def run(self):
-        self.start_listening()
         """Standard run method for threading."""
+        try:
+            self.start_listening()
+        finally:
+            self._listening = False
+            self.events.put(None)  # wake up anyone blocked in next_event()
 
     def _setup_lookup(self):
         """Setup the key lookups."""
@@ -118,17 +123,23 @@ class XEvents(threading.Thread):
         self.keycode_to_symbol[697] = 'KEY_IDOTLESS'  # scancode = 23 / 19
         self.keycode_to_symbol[442] = 'KEY_SCEDILLA'  # scancode = 39 / 40
 
-    def next_event(self):
-        """Returns the next event in queue, or None if none."""
-        if self.events:
-            return self.events.pop(0)
-        return None
+    def next_event(self, timeout=0):
+        """Returns the next event in queue, or None if none.
+
+        Waits up to timeout seconds for one to arrive; by default it does
+        not wait at all.
+        """
+        try:
+            if timeout > 0:
+                return self.events.get(timeout=timeout)
+            return self.events.get_nowait()
+        except queue.Empty:
+            return None
 
     def start_listening(self):
         """Start listening to RECORD extension and queuing events."""
         if not self.record_display.has_extension("RECORD"):
-            print
-            "RECORD extension not found"
+            print("RECORD extension not found")
             sys.exit(1)
         self._listening = True
         self.ctx = self.record_display.record_create_context(
@@ -160,6 +171,7 @@ class XEvents(threading.Thread):
         self.local_display.flush()
         self.local_display.close()
         self._listening = False
+        self.events.put(None)  # wake up anyone blocked in next_event()
         self.join(0.05)
 
     def listening(self):
@@ -187,8 +199,7 @@ class XEvents(threading.Thread):
             elif event.type == X.MotionNotify:
                 self._handle_mouse(event, 2)
             else:
-                print
-                event
+                print(event)
 
     def _handle_mouse(self, event, value):
         """Add a mouse event to events.
@@ -197,18 +208,18 @@ class XEvents(threading.Thread):
           value: 2=motion, 1=down, 0=up
         """
         if value == 2:
-            self.events.append(XEvent('EV_MOV',
-                                      0, 0, (event.root_x, event.root_y)))
+            self.events.put(XEvent('EV_MOV',
+                                   0, 0, (event.root_x, event.root_y)))
         elif event.detail in [4, 5]:
             if event.detail == 5:
                 value = -1
             else:
                 value = 1
-            self.events.append(XEvent('EV_REL',
-                                      0, XEvents._butn_to_code[event.detail], value))
+            self.events.put(XEvent('EV_REL',
+                                   0, XEvents._butn_to_code[event.detail], value))
         else:
-            self.events.append(XEvent('EV_KEY',
-                                      0, XEvents._butn_to_code[event.detail], value))
+            self.events.put(XEvent('EV_KEY',
+                                   0, XEvents._butn_to_code[event.detail], value))
 
     def _handle_key(self, event, value):
         """Add key event to events.
@@ -218,9 +229,8 @@ class XEvents(threading.Thread):
         """
         keysym = self.local_display.keycode_to_keysym(event.detail, 0)
         if keysym not in self.keycode_to_symbol:
-            print
-            'Missing code for %d = %d' % (event.detail - 8, keysym)
-        self.events.append(XEvent('EV_KEY', event.detail - 8, self.keycode_to_symbol[keysym], value))
+            print('Missing code for %d = %d' % (event.detail - 8, keysym))
+        self.events.put(XEvent('EV_KEY', event.detail - 8, self.keycode_to_symbol[keysym], value))
 
 
 def _run_test():
@@ -229,21 +239,17 @@ def _run_test():
     events.start()
     while not events.listening():
         time.sleep(1)
-        print
-        'Waiting for initializing...'
-    print
-    'Press ESCape to quit'
+        print('Waiting for initializing...')
+    print('Press ESCape to quit')
     try:
         while events.listening():
             try:
-                evt = events.next_event()
+                evt = events.next_event(0.5)
             except KeyboardInterrupt:
-                print
-                'User interrupted'
+                print('User interrupted')
                 events.stop_listening()
             if evt:
-                print
-                evt
+                print(evt)
                 if evt.code == 'KEY_ESCAPE':
                     events.stop_listening()
     finally: